@@ -1,23 +1,110 @@
 import streamlit as st
 import google.generativeai as genai
+import google.ai.generativelanguage as glm
+from google.generativeai.types import generation_types
+from google.api_core import exceptions as google_exceptions
+import asyncio
+import concurrent.futures
+import diskcache
+import hashlib
+import nest_asyncio
+import itertools
+import json
+import math
+import numpy as np
 import os
-import re # Import regex for parsing
+import re
+import threading
+from collections import Counter
+from typing_extensions import TypedDict # pydantic rejects typing.TypedDict in response schemas on Python < 3.12
+from errors import GenerationError
+
+# Allow asyncio.run() even if an event loop is already running in the script thread
+nest_asyncio.apply()
+
+# Material longer than this is condensed (summary), truncated (flashcards/quiz) or
+# narrowed to the most relevant passages (Q&A) before it is sent to Gemini
+MAX_CHARS = 60_000
+SUMMARY_CHUNK_CHARS = 40_000 # Chunk size for the summary map step
+SUMMARY_MAP_CONCURRENCY = 4 # Section summaries requested at once, to stay within rate limits
+QA_CHUNK_CHARS = 4_000 # Passage size for Q&A retrieval
+PREVIEW_CHARS = 2_048 # Only this much of the material is sent to the browser for the preview
+_WORD_RE = re.compile(r"\w+")
+
+# Using gemini-2.0-flash for speed and free tier compatibility
+MODEL_NAME = "gemini-2.0-flash"
+FALLBACK_MODEL_NAME = "gemini-1.5-flash-8b" # Tried when every key is rate limited or failing on MODEL_NAME
+EMBEDDING_MODEL_NAME = "models/text-embedding-004"
+QA_SIMILARITY_THRESHOLD = 0.92 # Cosine similarity above which a previous answer is reused
+GEMINI_CACHE_DIR = "/tmp/gemini_cache" # Persistent response cache, shared across sessions and restarts
+# Errors worth retrying with another key or the fallback model: rate limits (429) and server errors (5xx)
+RETRYABLE_ERRORS = (google_exceptions.ResourceExhausted, google_exceptions.InternalServerError, google_exceptions.ServiceUnavailable)
+
+def _load_api_keys():
+    """Reads GOOGLE_API_KEY_1..N from Streamlit secrets, falling back to the single GOOGLE_API_KEY."""
+    keys = []
+    while f"GOOGLE_API_KEY_{len(keys) + 1}" in st.secrets:
+        keys.append(st.secrets[f"GOOGLE_API_KEY_{len(keys) + 1}"])
+    return keys or [st.secrets["GOOGLE_API_KEY"]]
+
+def _build_model(name, api_key):
+    """Builds a model bound to its own API key for synchronous calls.
+    genai.configure() is process-wide, so each model gets an explicit client instead of the shared default."""
+    bound_model = genai.GenerativeModel(name)
+    # _client / _async_client are private: this relies on the pinned google-generativeai==0.8.5,
+    # where GenerativeModel only creates a default client when these are None
+    bound_model._client = glm.GenerativeServiceClient(client_options={"api_key": api_key})
+    return bound_model
+
+# Async models created during a run_async() call, keyed by its event loop. gRPC aio channels are
+# bound to the loop that created them, so they are created inside the run and closed when it ends.
+_async_models = {}
+
+def _async_model(name, api_key):
+    """Returns a model bound to api_key whose async client belongs to the running event loop."""
+    loop_models = _async_models.setdefault(asyncio.get_running_loop(), {})
+    if (name, api_key) not in loop_models:
+        bound_model = genai.GenerativeModel(name)
+        # Private attribute, see _build_model (google-generativeai==0.8.5 internals)
+        bound_model._async_client = glm.GenerativeServiceAsyncClient(client_options={"api_key": api_key})
+        loop_models[(name, api_key)] = bound_model
+    return loop_models[(name, api_key)]
+
+def run_async(coro):
+    """Runs coro to completion, then closes the async Gemini clients it created."""
+    async def run_and_close():
+        try:
+            return await coro
+        finally:
+            for bound_model in _async_models.pop(asyncio.get_running_loop(), {}).values():
+                await bound_model._async_client.transport.close()
+    return asyncio.run(run_and_close())
 
 # --- Application Structure ---
 st.set_page_config(page_title="AI Study Buddy", layout="wide")
 # --- Configuration ---
 # Load API key from Streamlit secrets for secure deployment
+@st.cache_resource
+def _get_models():
+    """Configures Gemini and builds the per-key models once per process rather than on every rerun.
+    Returns the API keys, the models, their fallback counterparts and the shared round-robin key cycle."""
+    # Attempt to retrieve the API key(s) from Streamlit secrets
+    api_keys = _load_api_keys()
+    genai.configure(api_key=api_keys[0])
+    # One model per key, used in round-robin order to spread requests across rate limits
+    models = [_build_model(MODEL_NAME, key) for key in api_keys]
+    fallback_models = [_build_model(FALLBACK_MODEL_NAME, key) for key in api_keys]
+    return api_keys, models, fallback_models, itertools.cycle(range(len(api_keys)))
+
 try:
-    # Attempt to retrieve the API key from Streamlit secrets
-    API_KEY = st.secrets["GOOGLE_API_KEY"]
-    genai.configure(api_key=API_KEY)
-    # Using gemini-1.5-flash for speed and free tier compatibility
-    model = genai.GenerativeModel("gemini-2.0-flash")
-    st.sidebar.success("Gemini API Key Loaded Successfully!") # Optional: Confirm key load
+    API_KEYS, models, fallback_models, _key_cycle = _get_models()
+    if 'banner_shown' not in st.session_state:
+        st.session_state.banner_shown = True
+        st.sidebar.success(f"Gemini API Key{'s' if len(API_KEYS) > 1 else ''} Loaded Successfully!") # Optional: Confirm key load
 except KeyError:
     # Handle missing secret
     st.error("IMPORTANT: GOOGLE_API_KEY not found in Streamlit secrets.")
-    st.error("Please go to your app settings on Streamlit Community Cloud, add a secret named GOOGLE_API_KEY, and paste your Gemini API key as the value.")
+    st.error("Please go to your app settings on Streamlit Community Cloud, add a secret named GOOGLE_API_KEY (or GOOGLE_API_KEY_1, GOOGLE_API_KEY_2, ... to rotate several keys), and paste your Gemini API key as the value.")
     st.stop() # Stop execution if API key secret is missing
 except Exception as e:
     # Handle other potential configuration errors
@@ -26,89 +113,351 @@ except Exception as e:
     st.stop() # Stop execution on other errors
 
 # --- Helper Functions (Gemini API Calls) ---
-def generate_with_gemini(prompt):
+# Add safety settings to reduce chances of blocking
+SAFETY_SETTINGS = [
+    {
+        "category": "HARM_CATEGORY_HARASSMENT",
+        "threshold": "BLOCK_MEDIUM_AND_ABOVE"
+    },
+    {
+        "category": "HARM_CATEGORY_HATE_SPEECH",
+        "threshold": "BLOCK_MEDIUM_AND_ABOVE"
+    },
+    {
+        "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
+        "threshold": "BLOCK_MEDIUM_AND_ABOVE"
+    },
+    {
+        "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
+        "threshold": "BLOCK_MEDIUM_AND_ABOVE"
+    },
+]
+
+def _rotation():
+    """Yields (model name, key index) pairs: each key on MODEL_NAME, starting from the next key
+    in the round-robin, then each key on FALLBACK_MODEL_NAME."""
+    start = next(_key_cycle)
+    order = [(start + i) % len(API_KEYS) for i in range(len(API_KEYS))]
+    for name in (MODEL_NAME, FALLBACK_MODEL_NAME):
+        for i in order:
+            yield name, i
+
+def _call_with_rotation(call):
+    """Runs call(model), moving on to the next key (and finally the fallback model) on rate limits and server errors.
+    Returns the result and the name of the model that produced it."""
+    for name, i in _rotation():
+        try:
+            return call((models if name == MODEL_NAME else fallback_models)[i]), name
+        except RETRYABLE_ERRORS as e:
+            last_error = e
+        except google_exceptions.GoogleAPICallError:
+            if name == MODEL_NAME:
+                raise
+            raise last_error # Report why the primary model failed, not the fallback's own error
+    raise last_error
+
+async def _acall_with_rotation(call):
+    """Async counterpart of _call_with_rotation, using models bound to the running event loop."""
+    for name, i in _rotation():
+        try:
+            return await call(_async_model(name, API_KEYS[i])), name
+        except RETRYABLE_ERRORS as e:
+            last_error = e
+        except google_exceptions.GoogleAPICallError:
+            if name == MODEL_NAME:
+                raise
+            raise last_error # Report why the primary model failed, not the fallback's own error
+    raise last_error
+
+def _response_text(response):
+    """Returns the response text, or an error message if the content was blocked or empty."""
+    # Check for empty response or blocked content
+    if not response.parts:
+         if response.prompt_feedback and response.prompt_feedback.block_reason:
+             return GenerationError(f"Content generation blocked. Reason: {response.prompt_feedback.block_reason.name}")
+         else:
+             # Sometimes empty parts list means blocked, check candidates
+             if response.candidates and response.candidates[0].finish_reason != 'STOP':
+                 return GenerationError(f"Content generation stopped. Reason: {response.candidates[0].finish_reason.name}")
+             else:
+                 return GenerationError("Error: Received an empty response from the API.")
+    return response.text
+
+@st.cache_resource
+def _response_cache():
+    """Opens the on-disk response cache once per process."""
+    return diskcache.Cache(GEMINI_CACHE_DIR, size_limit=2**30)
+
+def _cache_key(prompt, generation_config=None):
+    """Keys a MODEL_NAME response on the prompt and generation config.
+    The normalised config spells out any response schema, so changing the schema changes the key."""
+    config = generation_types.to_generation_config_dict(generation_config)
+    return hashlib.sha256(f"{MODEL_NAME}\n{config}\n{prompt}".encode("utf-8")).hexdigest()
+
+def _cache_response(key, text, model_name):
+    """Stores a response from MODEL_NAME. Error and block messages are not cached, and neither are
+    fallback-model answers, which would otherwise be served in place of the primary model's."""
+    if model_name == MODEL_NAME and not isinstance(text, GenerationError):
+        _response_cache()[key] = text
+
+def generate_with_gemini(prompt, generation_config=None):
     """Generic function to call Gemini API and handle potential errors."""
+    key = _cache_key(prompt, generation_config)
+    cached = _response_cache().get(key)
+    if cached is not None:
+        return cached
     try:
-        # Add safety settings to reduce chances of blocking
-        safety_settings = [
-            {
-                "category": "HARM_CATEGORY_HARASSMENT",
-                "threshold": "BLOCK_MEDIUM_AND_ABOVE"
-            },
-            {
-                "category": "HARM_CATEGORY_HATE_SPEECH",
-                "threshold": "BLOCK_MEDIUM_AND_ABOVE"
-            },
-            {
-                "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                "threshold": "BLOCK_MEDIUM_AND_ABOVE"
-            },
-            {
-                "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
-                "threshold": "BLOCK_MEDIUM_AND_ABOVE"
-            },
-        ]
-        response = model.generate_content(prompt, safety_settings=safety_settings)
-        # Check for empty response or blocked content
-        if not response.parts:
-             if response.prompt_feedback and response.prompt_feedback.block_reason:
-                 return f"Content generation blocked. Reason: {response.prompt_feedback.block_reason.name}"
-             else:
-                 # Sometimes empty parts list means blocked, check candidates
-                 if response.candidates and response.candidates[0].finish_reason != 'STOP':
-                     return f"Content generation stopped. Reason: {response.candidates[0].finish_reason.name}"
-                 else:
-                     return "Error: Received an empty response from the API."
-        return response.text
+        response, model_name = _call_with_rotation(lambda m: m.generate_content(prompt, generation_config=generation_config, safety_settings=SAFETY_SETTINGS))
+        text = _response_text(response)
+    except Exception as e:
+        return GenerationError(f"An error occurred during generation: {e}")
+    _cache_response(key, text, model_name)
+    return text
+
+def stream_with_gemini(prompt, generation_config=None):
+    """Yields the Gemini response text chunk by chunk as it is generated.
+    A failure is yielded as a final GenerationError chunk, possibly after some text."""
+    key = _cache_key(prompt, generation_config)
+    cached = _response_cache().get(key)
+    if cached is not None:
+        yield cached
+        return
+    try:
+        # Rate limits surface on the first chunk, which generate_content reads before returning
+        response, model_name = _call_with_rotation(lambda m: m.generate_content(prompt, stream=True, generation_config=generation_config, safety_settings=SAFETY_SETTINGS))
+        chunks = []
+        for chunk in response:
+            if chunk.parts:
+                chunks.append(chunk.text)
+                yield chunks[-1]
+        if chunks:
+            _cache_response(key, "".join(chunks), model_name)
+        else:
+            # Nothing streamed: report why (blocked, stopped or empty)
+            yield _response_text(response)
+    except Exception as e:
+        yield GenerationError(f"An error occurred during generation: {e}")
+
+def write_stream_with_gemini(prompt):
+    """Renders the response with st.write_stream as it arrives and returns the full text.
+    If the call fails, even part-way through, returns the GenerationError instead; text already
+    shown stays on screen but is not returned as a result."""
+    failure = []
+    def text_chunks():
+        for chunk in stream_with_gemini(prompt):
+            if isinstance(chunk, GenerationError):
+                failure.append(chunk)
+                return
+            yield chunk
+    text = st.write_stream(text_chunks())
+    return failure[0] if failure else text
+
+def collect_stream(prompt, placeholder, label, generation_config=None):
+    """Accumulates a streamed response, showing progress in the given placeholder."""
+    text = ""
+    for chunk in stream_with_gemini(prompt, generation_config):
+        if isinstance(chunk, GenerationError):
+            placeholder.empty()
+            return chunk
+        text += chunk
+        placeholder.caption(f"{label} ({len(text):,} characters received)")
+    placeholder.empty()
+    return text
+
+@st.cache_resource
+def _inflight_calls():
+    """Process-wide map of prompt hash -> concurrent.futures.Future for async calls in progress,
+    with its lock. These futures are thread-safe, so requests from other reruns, sessions and
+    event loops can wait on them."""
+    return {}, threading.Lock()
+
+async def agenerate_with_gemini(prompt, generation_config=None):
+    """Async counterpart of generate_with_gemini, so several calls can run concurrently.
+    A request for a prompt that is already being generated waits for that call instead of repeating it."""
+    key = _cache_key(prompt, generation_config)
+    cached = _response_cache().get(key)
+    if cached is not None:
+        return cached
+    inflight, lock = _inflight_calls()
+    with lock:
+        future = inflight.get(key)
+        is_owner = future is None
+        if is_owner:
+            future = inflight[key] = concurrent.futures.Future()
+    if not is_owner:
+        return await asyncio.wrap_future(future)
+    try:
+        # A previous owner may have finished and cached it between the first lookup and the lock
+        text = _response_cache().get(key)
+        if text is None:
+            text = await _agenerate_uncached(prompt, key, generation_config)
+    except BaseException as e:
+        # E.g. cancelled: waiters get an error message rather than hanging
+        future.set_result(GenerationError(f"An error occurred during generation: {e!r}"))
+        raise
+    else:
+        future.set_result(text)
+    finally:
+        with lock:
+            inflight.pop(key, None)
+    return text
+
+async def _agenerate_uncached(prompt, key, generation_config):
+    try:
+        response, model_name = await _acall_with_rotation(lambda m: m.generate_content_async(prompt, generation_config=generation_config, safety_settings=SAFETY_SETTINGS))
+        text = _response_text(response)
     except Exception as e:
-        return f"An error occurred during generation: {e}"
-
-def generate_summary(text):
-    """Generates a concise summary of the provided text using Gemini API."""
-    if not text:
-        return "Please provide some text to summarize."
-    prompt = f"Please provide a concise summary of the following text, highlighting the key points and concepts suitable for studying: \n---\n{text}---"
-    return generate_with_gemini(prompt)
-
-def generate_flashcards(text):
-    """Generates flashcards (Q/A pairs) from the provided text using Gemini API."""
-    if not text:
-        return "Please provide some text to generate flashcards from."
-    prompt = f"Generate flashcards based on the key information in the following text. Format each flashcard strictly as:\nQuestion: [Your Question Here]\nAnswer: [Your Answer Here]\n\nEnsure there is a blank line between each flashcard.\n\n---\n{text}---"
-    flashcards_text = generate_with_gemini(prompt)
-    if flashcards_text.startswith("An error occurred") or flashcards_text.startswith("Content generation") or flashcards_text.startswith("Error:"):
-        return flashcards_text # Return error/block message directly
-
-    pattern = re.compile(r"Question:\s*(.*?)\nAnswer:\s*(.*?)(?=\n\nQuestion:|\Z)", re.DOTALL | re.IGNORECASE)
-    matches = pattern.findall(flashcards_text)
-    flashcards = [(q.strip(), a.strip()) for q, a in matches]
-
-    if not flashcards:
-        if flashcards_text.strip(): return f"Could not parse flashcards from the response. Raw response:\n{flashcards_text}"
-        else: return "The model did not generate any flashcards or the response was empty."
-    return flashcards
-
-def generate_quiz(text):
-    """Generates a multiple-choice quiz from the provided text using Gemini API."""
-    if not text:
-        return "Please provide some text to generate a quiz from."
-    prompt = f"Generate a multiple-choice quiz (around 3-5 questions) based on the key information in the following text. For each question, provide 4 options (A, B, C, D) and indicate the correct answer. Format each question strictly as:\nQuestion: [Your Question Here]\nA) [Option A]\nB) [Option B]\nC) [Option C]\nD) [Option D]\nAnswer: [Correct Option Letter]\n\nEnsure there is a blank line between each question block.\n\n---\n{text}---"
-    quiz_text = generate_with_gemini(prompt)
-    if quiz_text.startswith("An error occurred") or quiz_text.startswith("Content generation") or quiz_text.startswith("Error:"):
-        return quiz_text # Return error/block message directly
-
-    pattern = re.compile(r"Question:\s*(.*?)\nA\)\s*(.*?)\nB\)\s*(.*?)\nC\)\s*(.*?)\nD\)\s*(.*?)\nAnswer:\s*([A-D])", re.DOTALL | re.IGNORECASE)
-    matches = pattern.findall(quiz_text)
-    quiz_items = []
-    for match in matches:
-        question, opt_a, opt_b, opt_c, opt_d, answer = [m.strip() for m in match]
-        options = {"A": opt_a, "B": opt_b, "C": opt_c, "D": opt_d}
-        quiz_items.append({"question": question, "options": options, "answer": answer.upper()})
-
-    if not quiz_items:
-        if quiz_text.strip(): return f"Could not parse quiz questions from the response. Raw response:\n{quiz_text}"
-        else: return "The model did not generate any quiz questions or the response was empty."
-    return quiz_items
+        return GenerationError(f"An error occurred during generation: {e}")
+    _cache_response(key, text, model_name)
+    return text
+
+def chunk_text(text, size):
+    """Splits text into pieces of at most `size` characters, preferring paragraph and line breaks."""
+    chunks = []
+    while len(text) > size:
+        cut = text.rfind("\n\n", 0, size)
+        if cut <= 0: cut = text.rfind("\n", 0, size)
+        if cut <= 0: cut = size
+        chunks.append(text[:cut])
+        text = text[cut:].lstrip()
+    if text: chunks.append(text)
+    return chunks
+
+def truncate_material(text):
+    """Caps the material at MAX_CHARS so a single prompt stays within budget."""
+    return text if len(text) <= MAX_CHARS else text[:MAX_CHARS]
+
+async def acondense_material(text):
+    """Map step for long material: summarizes its chunks concurrently, a few at a time, and repeats
+    over the joined section summaries until they fit in MAX_CHARS. The summary prompt then reduces
+    them. Short text is returned unchanged."""
+    semaphore = asyncio.Semaphore(SUMMARY_MAP_CONCURRENCY)
+
+    async def summarize_section(chunk):
+        async with semaphore:
+            return await agenerate_with_gemini(summary_prompt(chunk))
+
+    while len(text) > MAX_CHARS:
+        sections = await asyncio.gather(*(summarize_section(chunk) for chunk in chunk_text(text, SUMMARY_CHUNK_CHARS)))
+        for section in sections:
+            if isinstance(section, GenerationError):
+                return section # Return error/block message directly
+        condensed = "\n\n".join(sections)
+        if len(condensed) >= len(text):
+            break # Summaries are not getting shorter; stop rather than loop forever
+        text = condensed
+    return text
+
+def retrieve_context(text, question):
+    """Returns the passages of text most relevant to the question, in document order and within MAX_CHARS.
+    Passages are ranked by TF-IDF weighted overlap with the question's words."""
+    if len(text) <= MAX_CHARS:
+        return text
+    passages = chunk_text(text, QA_CHUNK_CHARS)
+    counts = [Counter(_WORD_RE.findall(p.lower())) for p in passages]
+    question_words = set(_WORD_RE.findall(question.lower()))
+    idf = {w: math.log(len(passages) / (1 + sum(w in c for c in counts))) + 1 for w in question_words}
+    scores = [sum(c[w] * idf[w] for w in question_words) for c in counts]
+    ranked = sorted(range(len(passages)), key=scores.__getitem__, reverse=True)
+    top_k = sorted(ranked[:MAX_CHARS // QA_CHUNK_CHARS])
+    return "\n\n".join(passages[i] for i in top_k)
+
+def summary_prompt(text):
+    return f"Please provide a concise summary of the following text, highlighting the key points and concepts suitable for studying: \n---\n{truncate_material(text)}---"
+
+# Flashcards and quiz come from one call whose JSON output follows this schema
+class Flashcard(TypedDict):
+    question: str
+    answer: str
+
+class QuizQuestion(TypedDict):
+    question: str
+    option_a: str
+    option_b: str
+    option_c: str
+    option_d: str
+    answer: str # Correct option letter
+
+class StudyPack(TypedDict):
+    flashcards: list[Flashcard]
+    quiz: list[QuizQuestion]
+
+STUDY_PACK_CONFIG = {"response_mime_type": "application/json", "response_schema": StudyPack}
+
+def study_pack_prompt(text):
+    return f"Based on the key information in the following text, generate flashcards (a question and its answer) and a multiple-choice quiz of around 3-5 questions. Each quiz question has 4 options (A, B, C, D) and the letter of the correct option as its answer.\n\n---\n{truncate_material(text)}---"
+
+def parse_study_pack(pack_text):
+    """Parses the model's JSON response into {"flashcards": [(question, answer), ...], "quiz": [question dicts]}.
+    Returns an error message instead if the response could not be used."""
+    if isinstance(pack_text, GenerationError):
+        return pack_text # Return error/block message directly
+    try:
+        pack = json.loads(pack_text)
+        flashcards = [(card["question"].strip(), card["answer"].strip()) for card in pack.get("flashcards", [])]
+        quiz_items = []
+        for item in pack.get("quiz", []):
+            options = {letter: item[f"option_{letter.lower()}"].strip() for letter in "ABCD"}
+            answer = item["answer"].strip()[:1].upper()
+            if answer in options:
+                quiz_items.append({"question": item["question"].strip(), "options": options, "answer": answer})
+    except (json.JSONDecodeError, AttributeError, KeyError, TypeError):
+        return GenerationError(f"Could not parse flashcards and quiz from the response. Raw response:\n{pack_text}")
+
+    return {
+        "flashcards": flashcards or GenerationError("The model did not generate any flashcards or the response was empty."),
+        "quiz": quiz_items or GenerationError("The model did not generate any quiz questions or the response was empty."),
+    }
+
+def is_complete_study_pack(pack):
+    """True when both the flashcards and the quiz were generated and parsed."""
+    return not isinstance(pack, GenerationError) and isinstance(pack["flashcards"], list) and isinstance(pack["quiz"], list)
+
+def _parse_and_check_study_pack(text, pack_text):
+    """Parses a study pack response. Unless both parts are usable, the response is dropped from the
+    disk cache (e.g. JSON cut off at the token limit), so the next request generates it again."""
+    pack = parse_study_pack(pack_text)
+    if not is_complete_study_pack(pack):
+        _response_cache().delete(_cache_key(study_pack_prompt(text), STUDY_PACK_CONFIG))
+    return pack
+
+async def agenerate_summary(text):
+    material = await acondense_material(text)
+    if isinstance(material, GenerationError):
+        return material
+    return await agenerate_with_gemini(summary_prompt(material))
+
+async def agenerate_study_pack(text):
+    return _parse_and_check_study_pack(text, await agenerate_with_gemini(study_pack_prompt(text), STUDY_PACK_CONFIG))
+
+async def generate_all(text):
+    """Generates the summary and the flashcards/quiz pack concurrently, so the wait is the slowest call rather than the sum."""
+    return await asyncio.gather(agenerate_summary(text), agenerate_study_pack(text))
+
+def get_study_pack(text):
+    """Returns the flashcards/quiz pack for the material, generating it only if neither tab has yet.
+    Only complete packs are kept; errors and half-failed packs are returned, so the next click retries."""
+    if st.session_state.study_pack is None:
+        with st.spinner("Generating flashcards and quiz..."):
+            pack = _parse_and_check_study_pack(text, collect_stream(study_pack_prompt(text), st.empty(), "Receiving flashcards and quiz", STUDY_PACK_CONFIG))
+        if not is_complete_study_pack(pack):
+            return pack
+        st.session_state.study_pack = pack
+    return st.session_state.study_pack
+
+class _AnswerFailed(Exception):
+    """Carries a GenerationError out of _cached_answer; st.cache_data does not cache exceptions."""
+
+# Cached on (context, question), so asking again about unchanged material skips passage
+# retrieval and the API call. Failures are raised rather than returned, so they are not cached.
+@st.cache_data(show_spinner=False, max_entries=128)
+def _cached_answer(context, question):
+    context = retrieve_context(context, question)
+    prompt = f"Based *only* on the following text, answer the question provided. If the answer cannot be found in the text, say 'The answer is not found in the provided text.'\n\nContext Text:\n---\n{context}---\n\nQuestion: {question}"
+    answer = generate_with_gemini(prompt)
+    if isinstance(answer, GenerationError):
+        raise _AnswerFailed(answer)
+    return answer
 
 def generate_answer(context, question):
     """Answers a question based on the provided context using Gemini API."""
@@ -116,8 +465,33 @@ def generate_answer(context, question):
         return "Please provide study material first."
     if not question:
         return "Please enter a question."
-    prompt = f"Based *only* on the following text, answer the question provided. If the answer cannot be found in the text, say 'The answer is not found in the provided text.'\n\nContext Text:\n---\n{context}---\n\nQuestion: {question}"
-    return generate_with_gemini(prompt)
+    try:
+        return _cached_answer(context, question)
+    except _AnswerFailed as e:
+        return e.args[0]
+
+def _embed_question(question):
+    """Returns the unit-length embedding of a question, so dot products are cosine similarities."""
+    embedding = np.array(genai.embed_content(model=EMBEDDING_MODEL_NAME, content=question, task_type="semantic_similarity")["embedding"])
+    return embedding / np.linalg.norm(embedding)
+
+def answer_question(context, question):
+    """Answers a question about the current material, reusing the answer to an earlier
+    question with the same meaning (e.g. "What is X?" and "Explain X") when there is one."""
+    try:
+        question_embedding = _embed_question(question)
+    except Exception:
+        return generate_answer(context, question) # Semantic cache unavailable; answer directly
+    if st.session_state.qa_embeddings:
+        similarities = np.vstack(st.session_state.qa_embeddings) @ question_embedding
+        best = int(similarities.argmax())
+        if similarities[best] > QA_SIMILARITY_THRESHOLD:
+            return st.session_state.qa_answers[best]
+    answer = generate_answer(context, question)
+    if not isinstance(answer, GenerationError):
+        st.session_state.qa_embeddings.append(question_embedding)
+        st.session_state.qa_answers.append(answer)
+    return answer
 
 
 
@@ -126,171 +500,192 @@ st.caption("Upload your study material (text) and let AI help you learn!")
 
 # Initialize session state variables
 if 'flashcard_states' not in st.session_state: st.session_state.flashcard_states = {}
-if 'quiz_answers' not in st.session_state: st.session_state.quiz_answers = {}
+if 'quiz_scored' not in st.session_state: st.session_state.quiz_scored = None # Score and per-question results, set on submit
 if 'show_quiz_results' not in st.session_state: st.session_state.show_quiz_results = False
 if 'quiz_result_data' not in st.session_state: st.session_state.quiz_result_data = None # Store quiz data
 if 'qa_answer' not in st.session_state: st.session_state.qa_answer = None
-if 'prev_pasted_text' not in st.session_state: st.session_state.prev_pasted_text = ""
-if 'prev_uploaded_filename' not in st.session_state: st.session_state.prev_uploaded_filename = None
+# Semantic Q&A cache for the current material: question embeddings and their answers
+if 'qa_embeddings' not in st.session_state: st.session_state.qa_embeddings = []
+if 'qa_answers' not in st.session_state: st.session_state.qa_answers = []
+if 'prev_uploaded_id' not in st.session_state: st.session_state.prev_uploaded_id = None
+if 'uploaded_text' not in st.session_state: st.session_state.uploaded_text = "" # Decoded contents of the current upload
 if 'summary_result' not in st.session_state: st.session_state.summary_result = None
 if 'flashcards_result' not in st.session_state: st.session_state.flashcards_result = None
+if 'study_pack' not in st.session_state: st.session_state.study_pack = None # Flashcards and quiz for the current material
+
+def _on_material_change():
+    """Clears previous results when the study material changes, within the same run."""
+    st.session_state.flashcard_states = {}
+    st.session_state.quiz_scored = None
+    st.session_state.show_quiz_results = False
+    st.session_state.quiz_result_data = None
+    st.session_state.qa_answer = None
+    st.session_state.qa_embeddings = []
+    st.session_state.qa_answers = []
+    st.session_state.summary_result = None
+    st.session_state.flashcards_result = None
+    st.session_state.study_pack = None
+    st.session_state.prev_uploaded_id = None # Treat the next upload as new
+
+# Button callbacks run before the script reruns, so the rerun already sees the new state
+def _flip_flashcard(card_key):
+    st.session_state.flashcard_states[card_key] = not st.session_state.flashcard_states.get(card_key, False)
+
+def _submit_quiz():
+    # Score once here; the results view only reads quiz_scored
+    per_item = []
+    for i, item in enumerate(st.session_state.quiz_result_data):
+        user_letter = st.session_state.get(f"quiz_{i}")
+        per_item.append((user_letter == item['answer'], user_letter, item['answer']))
+    st.session_state.quiz_scored = {"score": sum(ok for ok, _, _ in per_item), "per_item": per_item}
+    st.session_state.show_quiz_results = True
+
+def _retake_quiz():
+    st.session_state.show_quiz_results = False
+    st.session_state.quiz_scored = None # Clear the previous score
 
 # --- Sidebar for Input ---
 st.sidebar.header("Input Material")
-input_method = st.sidebar.radio("Choose input method:", ("Paste Text", "Upload Text File"), key="input_select")
+input_method = st.sidebar.radio("Choose input method:", ("Paste Text", "Upload Text File"), key="input_select", on_change=_on_material_change)
 
 study_material = ""
-reset_results = False
 
 if input_method == "Paste Text":
-    study_material = st.sidebar.text_area("Paste your study material here:", height=300, key="pasted_text")
-    if study_material != st.session_state.prev_pasted_text:
-        reset_results = True
-        st.session_state.prev_pasted_text = study_material
-        st.session_state.prev_uploaded_filename = None # Clear uploaded file state
+    study_material = st.sidebar.text_area("Paste your study material here:", height=300, key="pasted_text", on_change=_on_material_change)
 elif input_method == "Upload Text File":
-    uploaded_file = st.sidebar.file_uploader("Upload a .txt file", type=["txt"], key="uploaded_file")
+    uploaded_file = st.sidebar.file_uploader("Upload a .txt file", type=["txt"], key="uploaded_file", on_change=_on_material_change)
     if uploaded_file is not None:
-        # Check if it's a new file upload
-        if uploaded_file.name != st.session_state.get('prev_uploaded_filename'):
+        # Decode only when a new file is uploaded; later reruns reuse the stored text
+        if uploaded_file.file_id != st.session_state.prev_uploaded_id:
             try:
-                study_material = uploaded_file.read().decode("utf-8")
+                st.session_state.uploaded_text = uploaded_file.read().decode("utf-8")
                 st.sidebar.success("File uploaded successfully!")
-                reset_results = True
-                st.session_state.prev_uploaded_filename = uploaded_file.name
-                st.session_state.prev_pasted_text = "" # Clear pasted text state
+                st.session_state.prev_uploaded_id = uploaded_file.file_id
             except Exception as e:
                 st.sidebar.error(f"Error reading file: {e}")
-                study_material = "" # Ensure material is empty on error
-        else:
-             # If same file is re-selected, try to read it again
-             try:
-                 uploaded_file.seek(0)
-                 study_material = uploaded_file.read().decode("utf-8")
-             except Exception as e:
-                 st.sidebar.error(f"Error re-reading file: {e}")
-                 study_material = ""
-
-# Reset states if new material is provided
-if reset_results:
-    st.session_state.flashcard_states = {}
-    st.session_state.quiz_answers = {}
-    st.session_state.show_quiz_results = False
-    st.session_state.quiz_result_data = None
-    st.session_state.qa_answer = None
-    st.session_state.summary_result = None
-    st.session_state.flashcards_result = None
-    # Force rerun to clear old outputs if new material is loaded
-    st.rerun()
+                st.session_state.uploaded_text = "" # Ensure material is empty on error
+        study_material = st.session_state.uploaded_text
+
+if study_material:
+    if st.sidebar.button("Generate All", key="generate_all_btn"):
+        with st.spinner("Generating summary, flashcards and quiz..."):
+            summary, pack = run_async(generate_all(study_material))
+            st.session_state.summary_result = summary
+            if isinstance(pack, GenerationError): # Error/block message for both tabs
+                st.session_state.flashcards_result = st.session_state.quiz_result_data = pack
+            else:
+                if is_complete_study_pack(pack): # Half-failed packs are shown but not kept, so the tabs retry
+                    st.session_state.study_pack = pack
+                st.session_state.flashcards_result = pack["flashcards"]
+                st.session_state.quiz_result_data = pack["quiz"]
+            st.session_state.flashcard_states = {} # Reset flip states
+            st.session_state.quiz_scored = None # Clear old answers
+            st.session_state.show_quiz_results = False # Reset results view
 
 # --- Main Area for Features ---
 st.header("Study Tools")
 
 if study_material:
     st.subheader("Your Study Material:")
-    st.text_area("Preview", study_material, height=150, disabled=True, key="material_preview")
+    preview = study_material if len(study_material) <= PREVIEW_CHARS else study_material[:PREVIEW_CHARS] + "\n…[truncated]"
+    st.text_area("Preview", preview, height=150, disabled=True, key="material_preview")
 
     # --- Feature Tabs ---
     tab_summary, tab_flashcards, tab_quiz, tab_qa = st.tabs(["Summary", "Flashcards", "Quiz", "Ask Questions"])
 
     with tab_summary:
         if st.button("Generate Summary", key="summarize_btn"):
-            with st.spinner("Generating summary..."):
-                summary = generate_summary(study_material)
-                st.session_state.summary_result = summary # Store result
+            material = study_material
+            if len(material) > MAX_CHARS:
+                with st.spinner("Condensing long material..."):
+                    material = run_async(acondense_material(material))
+            st.subheader("Summary:")
+            result = material
+            if not isinstance(result, GenerationError):
+                result = write_stream_with_gemini(summary_prompt(material))
+            st.session_state.summary_result = result
+            if isinstance(result, GenerationError):
+                st.error(result)
 
-        if st.session_state.summary_result:
+        elif st.session_state.summary_result:
             st.subheader("Summary:")
             result = st.session_state.summary_result
-            if result.startswith("An error occurred") or result.startswith("Content generation") or result.startswith("Error:"):
+            if isinstance(result, GenerationError):
                 st.error(result)
             else:
                 st.markdown(result)
 
     with tab_flashcards:
         if st.button("Generate Flashcards", key="flashcards_btn"):
-            with st.spinner("Generating flashcards..."):
-                flashcards_result = generate_flashcards(study_material)
-                st.session_state.flashcards_result = flashcards_result # Store result
-                st.session_state.flashcard_states = {} # Reset flip states
+            pack = get_study_pack(study_material)
+            st.session_state.flashcards_result = pack if isinstance(pack, GenerationError) else pack["flashcards"] # Store result
+            st.session_state.flashcard_states = {} # Reset flip states
 
         if st.session_state.flashcards_result:
             st.subheader("Flashcards:")
             result = st.session_state.flashcards_result
-            if isinstance(result, str): # Check if it's an error/block message
+            if isinstance(result, GenerationError): # Check if it's an error/block message
                 st.error(result)
             elif result:
+                cols = st.columns(3)
                 for i, (question, answer) in enumerate(result):
                     card_key = f"flashcard_{i}"
                     is_flipped = st.session_state.flashcard_states.get(card_key, False)
-                    with st.expander(f"**Flashcard {i+1}: {question}**", expanded=False):
+                    with cols[i % 3].container(border=True):
+                        st.markdown(f"**Flashcard {i+1}:** {question}")
                         if is_flipped:
                             st.write(f"**Answer:** {answer}")
-                            if st.button("Hide Answer", key=f"hide_{card_key}"):
-                                st.session_state.flashcard_states[card_key] = False
-                                st.rerun()
+                            st.button("Hide Answer", key=f"hide_{card_key}", on_click=_flip_flashcard, args=(card_key,))
                         else:
-                            if st.button("Show Answer", key=f"show_{card_key}"):
-                                st.session_state.flashcard_states[card_key] = True
-                                st.rerun()
+                            st.button("Show Answer", key=f"show_{card_key}", on_click=_flip_flashcard, args=(card_key,))
             else:
                 st.warning("No flashcards were generated or the response was empty.")
 
     with tab_quiz:
         if st.button("Generate Quiz", key="quiz_btn"):
-            with st.spinner("Generating quiz..."):
-                quiz_result = generate_quiz(study_material)
-                st.session_state.quiz_result_data = quiz_result # Store result
-                st.session_state.quiz_answers = {} # Clear old answers
-                st.session_state.show_quiz_results = False # Reset results view
+            pack = get_study_pack(study_material)
+            st.session_state.quiz_result_data = pack if isinstance(pack, GenerationError) else pack["quiz"] # Store result
+            st.session_state.quiz_scored = None # Clear old answers
+            st.session_state.show_quiz_results = False # Reset results view
 
         if st.session_state.quiz_result_data:
             st.subheader("Quiz Time!")
             quiz_data = st.session_state.quiz_result_data
-            if isinstance(quiz_data, str): # Check if it's an error/block message
+            if isinstance(quiz_data, GenerationError): # Check if it's an error/block message
                 st.error(quiz_data)
             elif quiz_data:
                 # Display quiz form if results are not shown
                 if not st.session_state.show_quiz_results:
                     for i, item in enumerate(quiz_data):
                         st.markdown(f"**Question {i+1}:** {item['question']}")
-                        options = list(item['options'].items())
-                        st.session_state.quiz_answers[i] = st.radio(
+                        options = item['options']
+                        # Options are the letters themselves, so the selection needs no parsing
+                        st.radio(
                             "Choose your answer:",
-                            [f"{k}) {v}" for k, v in options],
+                            list(options),
+                            format_func=lambda k, options=options: f"{k}) {options[k]}",
                             key=f"quiz_{i}",
                             index=None # Default to no selection
                         )
-                    if st.button("Submit Quiz", key="submit_quiz"):
-                        st.session_state.show_quiz_results = True
-                        st.rerun()
+                    st.button("Submit Quiz", key="submit_quiz", on_click=_submit_quiz)
                 # Display quiz results if submitted
                 else:
                     st.subheader("Quiz Results")
-                    score = 0
-                    total = len(quiz_data)
-                    for i, item in enumerate(quiz_data):
-                        user_answer_full = st.session_state.quiz_answers.get(i)
-                        user_answer_letter = user_answer_full.split(')')[0] if user_answer_full else None
-                        correct_answer = item['answer']
+                    scored = st.session_state.quiz_scored
+                    for i, (item, (is_correct, user_letter, correct_letter)) in enumerate(zip(quiz_data, scored["per_item"])):
                         st.markdown(f"**Question {i+1}:** {item['question']}")
-                        st.write(f"Your answer: {user_answer_full if user_answer_full else 'Not answered'}")
-                        st.write(f"Correct answer: {correct_answer}) {item['options'][correct_answer]}")
-                        if user_answer_letter == correct_answer:
+                        user_answer = f"{user_letter}) {item['options'][user_letter]}" if user_letter else "Not answered"
+                        st.write(f"Your answer: {user_answer}")
+                        st.write(f"Correct answer: {correct_letter}) {item['options'][correct_letter]}")
+                        if is_correct:
                             st.success("Correct!")
-                            score += 1
-                        elif user_answer_full:
+                        elif user_letter:
                             st.error("Incorrect.")
                         else:
                             st.warning("Not answered.")
                         st.markdown("---")
-                    st.markdown(f"**Your final score: {score}/{total}**")
-                    if st.button("Retake Quiz / New Quiz", key="hide_results"):
-                         st.session_state.show_quiz_results = False
-                         st.session_state.quiz_answers = {} # Clear answers for retake
-                         # Optionally clear quiz_result_data if you want 'Generate Quiz' to be pressed again
-                         # st.session_state.quiz_result_data = None
-                         st.rerun()
+                    st.markdown(f"**Your final score: {scored['score']}/{len(quiz_data)}**")
+                    st.button("Retake Quiz / New Quiz", key="hide_results", on_click=_retake_quiz)
             else:
                 st.warning("No quiz questions were generated or the response was empty.")
 
@@ -300,7 +695,7 @@ if study_material:
         if st.button("Get Answer", key="qa_btn"):
             if user_question:
                 with st.spinner("Thinking..."):
-                    answer = generate_answer(study_material, user_question)
+                    answer = answer_question(study_material, user_question)
                     st.session_state.qa_answer = answer # Store answer
             else:
                 st.warning("Please enter a question.")
@@ -308,7 +703,7 @@ if study_material:
         if st.session_state.qa_answer:
             st.markdown("**Answer:**")
             result = st.session_state.qa_answer
-            if result.startswith("An error occurred") or result.startswith("Content generation") or result.startswith("Error:"):
+            if isinstance(result, GenerationError):
                 st.error(result)
             else:
                 st.markdown(result)
@@ -0,0 +1,7 @@
+class GenerationError(str):
+    """Message returned in place of generated text when a Gemini call fails or is blocked.
+
+    Defined outside app.py because Streamlit re-executes the app script on every rerun,
+    which would redefine the class and break isinstance checks on results kept in
+    session_state.
+    """